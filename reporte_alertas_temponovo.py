@@ -2,16 +2,34 @@
 Reporte Automático de Alertas - Temponovo
 Envío: Lunes y jueves
 Adjuntos: Excel descuentos + PDF cobranza
+Exportación BI: CSV gzip (+ Parquet si hay pyarrow) en EXPORT_DIR
 """
 
 import xmlrpc.client
 import smtplib
 import ssl
 import os
+import sys
+import csv
+import gzip
+import uuid
+import base64
+import shutil
+import zipfile
+import tempfile
+import time
+import random
+import functools
+import contextlib
+import threading
+import traceback
+import http.client
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
-from email import encoders
+from email.generator import BytesGenerator
+from email.policy import SMTP as POLICY_SMTP
 from datetime import datetime, date, timedelta
 import io
 import openpyxl
@@ -23,6 +41,13 @@ from reportlab.lib.units import cm
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 
+# Opcional: sin pyarrow la exportación BI queda solo en CSV gzip
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
 # ══════════════════════════════════════════════
 # CONFIGURACIÓN
 # ══════════════════════════════════════════════
@@ -35,6 +60,9 @@ SMTP_HOST     = os.environ.get("SMTP_HOST", "srv10.akkuarios.com")
 SMTP_PORT     = int(os.environ.get("SMTP_PORT", "587"))
 SMTP_USER     = os.environ.get("SMTP_USER", "")
 SMTP_PASSWORD = os.environ.get("SMTP_PASSWORD", "")
+# Tamaño máximo por mensaje; si el servidor anuncia SIZE se usa el menor
+EMAIL_MAX_MB  = float(os.environ.get("EMAIL_MAX_MB", "20"))
+SPOOL_MAX     = 8 * 1024 * 1024   # sobre esto el mensaje se arma en disco
 
 # TEST_MODE = True  → manda solo a TEST_EMAIL para probar
 # TEST_MODE = False → manda a todos (producción)
@@ -56,26 +84,210 @@ DIAS_COTIZACION = 3
 DIAS_SIN_PICK   = 3
 DIAS_SIN_OUT    = 3
 
+# ── Plazos y reintentos RPC ──
+PLAZO_TOTAL_SEG     = float(os.environ.get("PLAZO_TOTAL_SEG", "1200"))     # todo el proceso
+RESERVA_ENVIO_SEG   = float(os.environ.get("RESERVA_ENVIO_SEG", "120"))    # adjuntos + SMTP
+PRESUPUESTO_SECCION = float(os.environ.get("PRESUPUESTO_SECCION", "300"))  # por sección
+RPC_TIMEOUT_SEG     = float(os.environ.get("RPC_TIMEOUT_SEG", "60"))
+RPC_REINTENTOS      = int(os.environ.get("RPC_REINTENTOS", "3"))
+RPC_BACKOFF_SEG     = 1.0
+RPC_BACKOFF_MAX_SEG = 30.0
+# RPC_HEDGE_SEG > 0 → si una lectura tarda más que esto, se lanza un duplicado
+# y se usa la primera respuesta. 0 = sin hedging.
+RPC_HEDGE_SEG       = float(os.environ.get("RPC_HEDGE_SEG", "0"))
+
+# ── Exportación BI ──
+# Opt-in: los datasets traen datos de clientes; EXPORT_DIR es obligatorio
+EXPORTAR_BI = os.environ.get("EXPORTAR_BI", "false").lower() == "true"
+EXPORT_DIR  = os.environ.get("EXPORT_DIR", "")
+PRESUPUESTO_EXPORT = float(os.environ.get("PRESUPUESTO_EXPORT", "1800"))  # corre después del email
+EXPORT_LOTE = int(os.environ.get("EXPORT_LOTE", "2000"))   # filas por row-group / página
+
 
 # ══════════════════════════════════════════════
 # CONEXIÓN ODOO
 # ══════════════════════════════════════════════
+class PlazoExcedido(Exception):
+    pass
+
+# Instantes (time.monotonic) límite vigentes; los fija main / ejecutar_seccion
+_plazo_global  = None
+_plazo_seccion = None
+
+def _restante():
+    fines = [p for p in (_plazo_global, _plazo_seccion) if p is not None]
+    return min(fines) - time.monotonic() if fines else None
+
+class _TimeoutMixin:
+    """Transport con timeout ajustable por llamada, conservando el keep-alive."""
+    timeout = RPC_TIMEOUT_SEG
+
+    def make_connection(self, host):
+        conn = super().make_connection(host)
+        conn.timeout = self.timeout          # conexión nueva: se aplica al conectar
+        if conn.sock is not None:            # conexión reutilizada: ajustar el socket
+            conn.sock.settimeout(self.timeout)
+        return conn
+
+class _Transporte(_TimeoutMixin, xmlrpc.client.Transport):
+    pass
+
+class _TransporteSeguro(_TimeoutMixin, xmlrpc.client.SafeTransport):
+    pass
+
+_locales = threading.local()
+_pool    = None
+
+# Hilos para hedging. Un perdedor ocupa su hilo hasta su timeout: si no hay
+# hilos libres no se hace hedge (ni se encola nada) y se llama directo.
+HILOS_HEDGE = 8
+_ocupados   = 0
+_ocupados_lock = threading.Lock()
+
+def _proxy(servicio, nuevo=False):
+    """ServerProxy del hilo actual (xmlrpc no es thread-safe), reutilizado entre
+    llamadas para no abrir una conexión TLS por cada execute_kw.
+    nuevo=True crea uno aparte, para el duplicado de un hedge."""
+    proxies = getattr(_locales, 'proxies', None)
+    if proxies is None:
+        proxies = _locales.proxies = {}
+    if servicio in proxies and not nuevo:
+        return proxies[servicio]
+    url  = f"{ODOO_URL}/xmlrpc/2/{servicio}"
+    tr   = _TransporteSeguro() if url.startswith('https') else _Transporte()
+    par  = (xmlrpc.client.ServerProxy(url, transport=tr), tr)
+    if not nuevo:
+        proxies[servicio] = par
+    return par
+
+def _es_transitorio(e):
+    if isinstance(e, xmlrpc.client.ProtocolError):
+        return e.errcode in (429, 502, 503, 504)
+    # Timeouts, conexiones cortadas/rechazadas, respuestas HTTP truncadas.
+    # Otros OSError (URL inválida, DNS, certificado TLS) son de configuración.
+    return isinstance(e, (TimeoutError, ConnectionError,
+                          http.client.RemoteDisconnected, http.client.IncompleteRead))
+
+def _es_degradable(e):
+    """Fallas por las que una sección se omite sin marcar la ejecución como error."""
+    return isinstance(e, PlazoExcedido) or _es_transitorio(e)
+
+def _llamar(servicio, metodo, *args, nuevo=False):
+    restante = _restante()
+    timeout  = RPC_TIMEOUT_SEG if restante is None else min(RPC_TIMEOUT_SEG, restante)
+    if timeout <= 0:
+        raise PlazoExcedido(f"sin tiempo para {servicio}.{metodo}")
+    proxy, tr = _proxy(servicio, nuevo)
+    tr.timeout = timeout
+    if nuevo:
+        try:
+            return getattr(proxy, metodo)(*args)
+        finally:
+            tr.close()
+    return getattr(proxy, metodo)(*args)
+
+def _reservar_hilo():
+    global _ocupados
+    with _ocupados_lock:
+        if _ocupados >= HILOS_HEDGE:
+            return False
+        _ocupados += 1
+        return True
+
+def _llamar_en_hilo(servicio, metodo, args, nuevo):
+    global _ocupados
+    try:
+        return _llamar(servicio, metodo, *args, nuevo=nuevo)
+    finally:
+        with _ocupados_lock:
+            _ocupados -= 1
+
+def _llamar_con_hedge(servicio, metodo, *args):
+    """Si la primera llamada no responde en RPC_HEDGE_SEG, lanza un duplicado
+    y devuelve la primera respuesta exitosa. Solo para lecturas."""
+    global _pool
+    if RPC_HEDGE_SEG <= 0 or not _reservar_hilo():
+        return _llamar(servicio, metodo, *args)
+    if _pool is None:
+        # Hilos persistentes: cada uno conserva su proxy (y su conexión)
+        _pool = ThreadPoolExecutor(max_workers=HILOS_HEDGE, thread_name_prefix='rpc')
+    pendientes = {_pool.submit(_llamar_en_hilo, servicio, metodo, args, False)}
+    listos, _ = wait(pendientes, timeout=RPC_HEDGE_SEG)
+    if not listos and _reservar_hilo():
+        pendientes.add(_pool.submit(_llamar_en_hilo, servicio, metodo, args, True))
+    error = None
+    while pendientes:
+        # No se espera al perdedor: su socket ya tiene timeout
+        listos, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+        for f in listos:
+            if f.exception() is None:
+                return f.result()
+            error = f.exception()
+    raise error
+
+def _rpc(servicio, metodo, *args, hedge=False):
+    """Llamada XML-RPC con reintentos (backoff exponencial con jitter)
+    acotada por el plazo global y el de la sección en curso."""
+    llamar = _llamar_con_hedge if hedge else _llamar
+    _proxy(servicio)   # URL inválida: falla aquí, sin reintentos
+    for intento in range(RPC_REINTENTOS + 1):
+        try:
+            return llamar(servicio, metodo, *args)
+        except Exception as e:
+            if not _es_transitorio(e) or intento == RPC_REINTENTOS:
+                raise
+            espera   = random.uniform(0, min(RPC_BACKOFF_MAX_SEG, RPC_BACKOFF_SEG * 2 ** intento))
+            restante = _restante()
+            if restante is not None and espera >= restante:
+                raise PlazoExcedido(f"sin tiempo para reintentar {metodo}: {e}") from e
+            print(f"     ⚠️  {metodo} falló ({e}); reintento {intento+1}/{RPC_REINTENTOS} en {espera:.1f}s")
+            time.sleep(espera)
+
 def conectar_odoo():
-    common = xmlrpc.client.ServerProxy(f"{ODOO_URL}/xmlrpc/2/common")
-    uid = common.authenticate(ODOO_DB, ODOO_USER, ODOO_PASSWORD, {})
+    uid = _rpc('common', 'authenticate', ODOO_DB, ODOO_USER, ODOO_PASSWORD, {})
     if not uid:
         raise Exception("Autenticación fallida.")
-    models = xmlrpc.client.ServerProxy(f"{ODOO_URL}/xmlrpc/2/object")
+    models = functools.partial(_rpc, 'object', 'execute_kw')
     return uid, models
 
-def buscar(models, uid, modelo, dominio, campos, limite=1000):
-    return models.execute_kw(
+def buscar(models, uid, modelo, dominio, campos, limite=1000, offset=0, orden=None):
+    opciones = {'fields': campos, 'limit': limite, 'offset': offset}
+    if orden:
+        opciones['order'] = orden
+    return models(
         ODOO_DB, uid, ODOO_PASSWORD,
         modelo, 'search_read',
         [dominio],
-        {'fields': campos, 'limit': limite}
+        opciones,
+        hedge=True,
     )
 
+def buscar_paginado(models, uid, modelo, dominio, campos, lote=EXPORT_LOTE):
+    """Igual que buscar pero sin tope: entrega páginas de `lote` registros."""
+    offset = 0
+    while True:
+        pagina = buscar(models, uid, modelo, dominio, campos, lote, offset, orden='id')
+        if pagina:
+            yield pagina
+        if len(pagina) < lote:
+            return
+        offset += lote
+
+def ejecutar_seccion(nombre, fn, *args, presupuesto=PRESUPUESTO_SECCION):
+    """Ejecuta una sección con su propio presupuesto de tiempo.
+    Devuelve (resultado, None) o (None, error) si falló o se pasó del plazo."""
+    global _plazo_seccion
+    _plazo_seccion = time.monotonic() + presupuesto
+    try:
+        return fn(*args), None
+    except Exception as e:
+        print(f"     ❌ {nombre} no disponible: {e}")
+        if not _es_degradable(e):
+            traceback.print_exc()
+        return None, e
+    finally:
+        _plazo_seccion = None
+
 
 # ══════════════════════════════════════════════
 # 1. DESCUENTOS — calculado desde list_price
@@ -86,125 +298,105 @@ def calc_descuento(precio_vendido, list_price):
         return 0.0
     return max(0.0, (list_price - precio_vendido) / list_price * 100)
 
-def get_descuentos(models, uid):
-    hoy        = date.today()
-    fecha_from = (hoy - timedelta(days=DESC_DIAS)).strftime('%Y-%m-%d')
+CAMPOS_LINEA_PEDIDO  = ['order_id', 'product_id', 'price_unit', 'product_uom_qty', 'price_subtotal']
+CAMPOS_LINEA_FACTURA = ['move_id', 'partner_id', 'product_id', 'price_unit', 'quantity', 'price_subtotal']
 
+def _dominios_descuentos():
+    fecha_from = (date.today() - timedelta(days=DESC_DIAS)).strftime('%Y-%m-%d')
     # Pedidos confirmados últimos 3 días (sin filtro de discount, calculamos nosotros)
-    lineas_pedido = buscar(models, uid,
-        'sale.order.line',
-        [
-            ['order_id.state', 'in', ['sale', 'done']],
-            ['order_id.date_order', '>=', fecha_from],
-            ['product_id', '!=', False],
-        ],
-        ['order_id', 'product_id', 'price_unit', 'product_uom_qty', 'price_subtotal']
-    )
-
+    pedidos = [
+        ['order_id.state', 'in', ['sale', 'done']],
+        ['order_id.date_order', '>=', fecha_from],
+        ['product_id', '!=', False],
+    ]
     # Facturas últimos 3 días
-    lineas_factura = buscar(models, uid,
-        'account.move.line',
-        [
-            ['move_id.move_type', '=', 'out_invoice'],
-            ['move_id.state', '=', 'posted'],
-            ['display_type', '=', 'product'],
-            ['move_id.invoice_date', '>=', fecha_from],
-            ['product_id', '!=', False],
-        ],
-        ['move_id', 'partner_id', 'product_id', 'price_unit', 'quantity', 'price_subtotal']
-    )
-
-    # Obtener list_price de todos los productos involucrados
-    prod_ids = set()
-    for l in lineas_pedido:
-        if l['product_id']: prod_ids.add(l['product_id'][0])
-    for l in lineas_factura:
-        if l['product_id']: prod_ids.add(l['product_id'][0])
-
-    list_prices = {}
-    if prod_ids:
+    facturas = [
+        ['move_id.move_type', '=', 'out_invoice'],
+        ['move_id.state', '=', 'posted'],
+        ['display_type', '=', 'product'],
+        ['move_id.invoice_date', '>=', fecha_from],
+        ['product_id', '!=', False],
+    ]
+    return pedidos, facturas
+
+def _list_prices(models, uid, lineas, cache):
+    """Completa cache {product_id: list_price} con los productos de las líneas."""
+    faltan = {l['product_id'][0] for l in lineas if l['product_id']} - cache.keys()
+    if faltan:
         prods = buscar(models, uid, 'product.product',
-            [['id', 'in', list(prod_ids)]],
-            ['id', 'list_price']
-        )
-        list_prices = {p['id']: p['list_price'] for p in prods}
-
-    # Info de pedidos (cliente, fecha, nombre)
-    pedido_ids = list({l['order_id'][0] for l in lineas_pedido if l['order_id']})
-    pedidos_info = {}
-    if pedido_ids:
+            [['id', 'in', list(faltan)]], ['id', 'list_price'], limite=len(faltan))
+        cache.update({p['id']: p['list_price'] for p in prods})
+    return cache
+
+def _info_pedidos(models, uid, lineas, cache):
+    """Completa cache {order_id: pedido} (cliente, fecha, nombre)."""
+    faltan = {l['order_id'][0] for l in lineas if l['order_id']} - cache.keys()
+    if faltan:
         raw = buscar(models, uid, 'sale.order',
-            [['id', 'in', pedido_ids]], ['id', 'partner_id', 'date_order', 'name'])
-        pedidos_info = {p['id']: p for p in raw}
-
-    # resumen email: una fila por CLIENTE (descuento máximo)
-    # detalle excel: una fila por producto
-    resumen_clientes = {}  # cliente -> {desc_max, pedidos}
-    detalle = []
-
-    for l in lineas_pedido:
+            [['id', 'in', list(faltan)]], ['id', 'partner_id', 'date_order', 'name'],
+            limite=len(faltan))
+        cache.update({p['id']: p for p in raw})
+    return cache
+
+def _linea_descuento(tipo, l, list_prices, pedidos_info):
+    """Fila de detalle de una línea de pedido o factura → (descuento, fila)."""
+    if tipo == 'Pedido':
         oid      = l['order_id'][0] if l['order_id'] else None
         pinfo    = pedidos_info.get(oid, {})
         cliente  = pinfo.get('partner_id', [None,''])[1] if pinfo else ''
-        pedido   = pinfo.get('name', '')
+        doc      = pinfo.get('name', '')
         fecha    = pinfo.get('date_order', '')[:10] if pinfo else ''
-        pid      = l['product_id'][0] if l['product_id'] else None
-        prod_str = l['product_id'][1] if l['product_id'] else ''
-        codigo   = prod_str.split(']')[0].replace('[','').strip() if ']' in prod_str else ''
-        nombre   = prod_str.split('] ')[-1] if ']' in prod_str else prod_str
-        lp       = list_prices.get(pid, 0)
-        desc     = calc_descuento(l['price_unit'], lp)
+        cantidad = l['product_uom_qty']
+    else:
+        cliente  = l['partner_id'][1] if l['partner_id'] else ''
+        doc      = l['move_id'][1] if l['move_id'] else ''
+        fecha    = ''
+        cantidad = l['quantity']
+    pid      = l['product_id'][0] if l['product_id'] else None
+    prod_str = l['product_id'][1] if l['product_id'] else ''
+    codigo   = prod_str.split(']')[0].replace('[','').strip() if ']' in prod_str else ''
+    nombre   = prod_str.split('] ')[-1] if ']' in prod_str else prod_str
+    lp       = list_prices.get(pid, 0)
+    desc     = calc_descuento(l['price_unit'], lp)
+    return desc, {
+        'Tipo': tipo, 'Cliente': cliente, 'N° Pedido': doc, 'Fecha': fecha,
+        'Código': codigo, 'Producto': nombre,
+        'Precio Lista': lp, 'Precio Vendido': l['price_unit'],
+        'Descuento %': round(desc, 1),
+        'Cantidad': cantidad, 'Subtotal': l['price_subtotal'],
+    }
 
-        if desc < DESC_AMARILLO:
-            continue
+def get_descuentos(models, uid):
+    dom_pedidos, dom_facturas = _dominios_descuentos()
+    lineas_pedido  = buscar(models, uid, 'sale.order.line', dom_pedidos, CAMPOS_LINEA_PEDIDO)
+    lineas_factura = buscar(models, uid, 'account.move.line', dom_facturas, CAMPOS_LINEA_FACTURA)
 
-        # Resumen por cliente
-        if cliente not in resumen_clientes:
-            resumen_clientes[cliente] = {'Cliente': cliente, 'Descuento': desc,
-                                          'Pedidos': pedido, 'Fecha': fecha}
-        else:
-            if desc > resumen_clientes[cliente]['Descuento']:
-                resumen_clientes[cliente]['Descuento'] = desc
-            if pedido not in resumen_clientes[cliente]['Pedidos']:
-                resumen_clientes[cliente]['Pedidos'] += f', {pedido}'
-
-        detalle.append({
-            'Tipo': 'Pedido', 'Cliente': cliente, 'N° Pedido': pedido, 'Fecha': fecha,
-            'Código': codigo, 'Producto': nombre,
-            'Precio Lista': lp, 'Precio Vendido': l['price_unit'],
-            'Descuento %': round(desc, 1),
-            'Cantidad': l['product_uom_qty'], 'Subtotal': l['price_subtotal'],
-        })
+    list_prices  = _list_prices(models, uid, lineas_pedido + lineas_factura, {})
+    pedidos_info = _info_pedidos(models, uid, lineas_pedido, {})
 
-    for l in lineas_factura:
-        cliente  = l['partner_id'][1] if l['partner_id'] else ''
-        factura  = l['move_id'][1] if l['move_id'] else ''
-        pid      = l['product_id'][0] if l['product_id'] else None
-        prod_str = l['product_id'][1] if l['product_id'] else ''
-        codigo   = prod_str.split(']')[0].replace('[','').strip() if ']' in prod_str else ''
-        nombre   = prod_str.split('] ')[-1] if ']' in prod_str else prod_str
-        lp       = list_prices.get(pid, 0)
-        desc     = calc_descuento(l['price_unit'], lp)
+    # resumen email: una fila por CLIENTE (descuento máximo)
+    # detalle excel: una fila por producto
+    resumen_clientes = {}  # cliente -> {desc_max, pedidos}
+    detalle = []
 
+    lineas = [('Pedido', l) for l in lineas_pedido] + [('Factura', l) for l in lineas_factura]
+    for tipo, l in lineas:
+        desc, fila = _linea_descuento(tipo, l, list_prices, pedidos_info)
         if desc < DESC_AMARILLO:
             continue
 
+        # Resumen por cliente
+        cliente, doc = fila['Cliente'], fila['N° Pedido']
         if cliente not in resumen_clientes:
             resumen_clientes[cliente] = {'Cliente': cliente, 'Descuento': desc,
-                                          'Pedidos': factura, 'Fecha': ''}
+                                          'Pedidos': doc, 'Fecha': fila['Fecha']}
         else:
             if desc > resumen_clientes[cliente]['Descuento']:
                 resumen_clientes[cliente]['Descuento'] = desc
-            if factura not in resumen_clientes[cliente]['Pedidos']:
-                resumen_clientes[cliente]['Pedidos'] += f', {factura}'
-
-        detalle.append({
-            'Tipo': 'Factura', 'Cliente': cliente, 'N° Pedido': factura, 'Fecha': '',
-            'Código': codigo, 'Producto': nombre,
-            'Precio Lista': lp, 'Precio Vendido': l['price_unit'],
-            'Descuento %': round(desc, 1),
-            'Cantidad': l['quantity'], 'Subtotal': l['price_subtotal'],
-        })
+            if doc not in resumen_clientes[cliente]['Pedidos']:
+                resumen_clientes[cliente]['Pedidos'] += f', {doc}'
+
+        detalle.append(fila)
 
     resumen = sorted(resumen_clientes.values(), key=lambda x: x['Descuento'], reverse=True)
     detalle.sort(key=lambda x: x['Descuento %'], reverse=True)
@@ -214,16 +406,23 @@ def get_descuentos(models, uid):
 # ══════════════════════════════════════════════
 # 2. COBRANZA VENCIDA
 # ══════════════════════════════════════════════
+FACTURAS_ABIERTAS = [
+    ['move_type', '=', 'out_invoice'],
+    ['payment_state', 'in', ['not_paid', 'partial']],
+    ['state', '=', 'posted'],
+]
+
+def tramo_aging(dias):
+    if dias <= 0:
+        return 'A la fecha'
+    return '1-30' if dias <= 30 else 'Vencido >30'
+
 def get_cobranza(models, uid):
     hoy = date.today()
 
     facturas = buscar(models, uid,
         'account.move',
-        [
-            ['move_type', '=', 'out_invoice'],
-            ['payment_state', 'in', ['not_paid', 'partial']],
-            ['state', '=', 'posted'],
-        ],
+        FACTURAS_ABIERTAS,
         ['name', 'partner_id', 'invoice_date_due', 'amount_residual', 'invoice_user_id']
     )
 
@@ -241,21 +440,10 @@ def get_cobranza(models, uid):
 
         venc_str = f.get('invoice_date_due') or ''
         monto    = f['amount_residual'] or 0.0
+        dias_v   = (hoy - datetime.strptime(venc_str, '%Y-%m-%d').date()).days if venc_str else 0
 
-        if venc_str:
-            venc = datetime.strptime(venc_str, '%Y-%m-%d').date()
-            dias = (hoy - venc).days
-            if dias <= 0:
-                clientes[pid]['A la fecha'] += monto
-            elif dias <= 30:
-                clientes[pid]['1-30'] += monto
-            else:
-                clientes[pid]['Vencido >30'] += monto
-        else:
-            clientes[pid]['A la fecha'] += monto
-
+        clientes[pid][tramo_aging(dias_v)] += monto
         clientes[pid]['Total'] += monto
-        dias_v = (hoy - datetime.strptime(venc_str, '%Y-%m-%d').date()).days if venc_str else 0
         clientes[pid]['facturas'].append({
             'Factura': f['name'], 'Fecha Venc.': venc_str,
             'Días Vencido': dias_v, 'Monto Pendiente': monto,
@@ -282,44 +470,57 @@ def get_cobranza(models, uid):
 # ══════════════════════════════════════════════
 # 3. PEDIDOS ATRASADOS
 # ══════════════════════════════════════════════
+CAMPOS_COTIZACION = ['name', 'partner_id', 'date_order', 'amount_total', 'user_id']
+CAMPOS_CONFIRMADO = CAMPOS_COTIZACION + ['picking_ids']
+
+def _dominios_atrasados():
+    hoy = date.today()
+    cotizaciones = [
+        ['state', '=', 'draft'],
+        ['date_order', '<', (hoy - timedelta(days=DIAS_COTIZACION)).strftime('%Y-%m-%d %H:%M:%S')],
+    ]
+    confirmados = [
+        ['state', '=', 'sale'],
+        ['date_order', '<', (hoy - timedelta(days=DIAS_SIN_PICK)).strftime('%Y-%m-%d %H:%M:%S')],
+    ]
+    return cotizaciones, confirmados
+
+def _base_pedido(p, hoy):
+    return {
+        'N° Pedido': p['name'],
+        'Cliente':   p['partner_id'][1] if p['partner_id'] else '',
+        'Vendedor':  p['user_id'][1] if p['user_id'] else '',
+        'Días':      (hoy - datetime.strptime(p['date_order'][:10], '%Y-%m-%d').date()).days,
+    }
+
+def _estado_confirmado(base, pickings):
+    """'No pickeado' / 'No en bulto' según los pickings del pedido, o None si va al día."""
+    picks = [pk for pk in pickings if 'PICK' in (pk.get('name') or '')]
+    outs  = [pk for pk in pickings if 'OUT'  in (pk.get('name') or '')]
+
+    pick_ok = any(pk['state'] == 'done' for pk in picks)
+    out_ok  = any(pk['state'] == 'done' for pk in outs)
+
+    if not pick_ok:
+        return 'No pickeado'
+    if not out_ok and base['Días'] >= DIAS_SIN_OUT:
+        return 'No en bulto'
+    return None
+
 def get_pedidos_atrasados(models, uid):
     hoy = date.today()
     cotizaciones, no_pickeados, no_en_bulto = [], [], []
+    dom_cot, dom_conf = _dominios_atrasados()
 
-    cots = buscar(models, uid, 'sale.order',
-        [
-            ['state', '=', 'draft'],
-            ['date_order', '<', (hoy - timedelta(days=DIAS_COTIZACION)).strftime('%Y-%m-%d %H:%M:%S')],
-        ],
-        ['name', 'partner_id', 'date_order', 'amount_total', 'user_id']
-    )
+    cots = buscar(models, uid, 'sale.order', dom_cot, CAMPOS_COTIZACION)
     for p in cots:
-        dias = (hoy - datetime.strptime(p['date_order'][:10], '%Y-%m-%d').date()).days
-        cotizaciones.append({
-            'N° Pedido': p['name'],
-            'Cliente':   p['partner_id'][1] if p['partner_id'] else '',
-            'Vendedor':  p['user_id'][1] if p['user_id'] else '',
-            'Estado':    'Sin confirmar',
-            'Días':      dias,
-        })
+        cotizaciones.append({**_base_pedido(p, hoy), 'Estado': 'Sin confirmar'})
 
-    confirmados = buscar(models, uid, 'sale.order',
-        [
-            ['state', '=', 'sale'],
-            ['date_order', '<', (hoy - timedelta(days=DIAS_SIN_PICK)).strftime('%Y-%m-%d %H:%M:%S')],
-        ],
-        ['name', 'partner_id', 'date_order', 'amount_total', 'user_id', 'picking_ids']
-    )
+    confirmados = buscar(models, uid, 'sale.order', dom_conf, CAMPOS_CONFIRMADO)
 
     for p in confirmados:
         picking_ids = p.get('picking_ids', [])
-        dias = (hoy - datetime.strptime(p['date_order'][:10], '%Y-%m-%d').date()).days
-        base = {
-            'N° Pedido': p['name'],
-            'Cliente':   p['partner_id'][1] if p['partner_id'] else '',
-            'Vendedor':  p['user_id'][1] if p['user_id'] else '',
-            'Días':      dias,
-        }
+        base = _base_pedido(p, hoy)
 
         if not picking_ids:
             no_pickeados.append({**base, 'Estado': 'No pickeado'})
@@ -327,16 +528,11 @@ def get_pedidos_atrasados(models, uid):
 
         pickings = buscar(models, uid, 'stock.picking',
             [['id', 'in', picking_ids]], ['name', 'state'])
-        picks = [pk for pk in pickings if 'PICK' in (pk.get('name') or '')]
-        outs  = [pk for pk in pickings if 'OUT'  in (pk.get('name') or '')]
-
-        pick_ok = any(pk['state'] == 'done' for pk in picks)
-        out_ok  = any(pk['state'] == 'done' for pk in outs)
-
-        if not pick_ok:
-            no_pickeados.append({**base, 'Estado': 'No pickeado'})
-        elif not out_ok and dias >= DIAS_SIN_OUT:
-            no_en_bulto.append({**base, 'Estado': 'No en bulto'})
+        estado = _estado_confirmado(base, pickings)
+        if estado == 'No pickeado':
+            no_pickeados.append({**base, 'Estado': estado})
+        elif estado == 'No en bulto':
+            no_en_bulto.append({**base, 'Estado': estado})
 
     cotizaciones.sort(key=lambda x: x['Días'], reverse=True)
     no_pickeados.sort(key=lambda x: x['Días'], reverse=True)
@@ -345,6 +541,183 @@ def get_pedidos_atrasados(models, uid):
     return cotizaciones + no_pickeados + no_en_bulto
 
 
+# ══════════════════════════════════════════════
+# EXPORTACIÓN BI — CSV gzip + Parquet
+# ══════════════════════════════════════════════
+# (columna, clave en la fila, tipo)
+COLS_DESCUENTOS = [
+    ('tipo',           'Tipo',           'str'),
+    ('cliente',        'Cliente',        'str'),
+    ('documento',      'N° Pedido',      'str'),
+    ('fecha',          'Fecha',          'date'),
+    ('codigo',         'Código',         'str'),
+    ('producto',       'Producto',       'str'),
+    ('precio_lista',   'Precio Lista',   'float'),
+    ('precio_vendido', 'Precio Vendido', 'float'),
+    ('descuento_pct',  'Descuento %',    'float'),
+    ('cantidad',       'Cantidad',       'float'),
+    ('subtotal',       'Subtotal',       'float'),
+]
+COLS_FACTURAS = [
+    ('factura',         'name',             'str'),
+    ('cliente_id',      'cliente_id',       'int'),
+    ('cliente',         'partner_id',       'str'),
+    ('vendedor',        'invoice_user_id',  'str'),
+    ('fecha_factura',   'invoice_date',     'date'),
+    ('fecha_venc',      'invoice_date_due', 'date'),
+    ('dias_vencido',    'dias_vencido',     'int'),
+    ('tramo',           'tramo',            'str'),
+    ('monto_total',     'amount_total',     'float'),
+    ('monto_pendiente', 'amount_residual',  'float'),
+]
+COLS_PEDIDOS = [
+    ('pedido',   'N° Pedido', 'str'),
+    ('cliente',  'Cliente',   'str'),
+    ('vendedor', 'Vendedor',  'str'),
+    ('estado',   'Estado',    'str'),
+    ('dias',     'Días',      'int'),
+]
+
+def _valor(v, tipo):
+    # Odoo devuelve False en campos vacíos y [id, nombre] en many2one
+    if v is None or v is False or v == '':
+        return None
+    if isinstance(v, list):
+        v = v[1]
+    if tipo == 'date':
+        return date.fromisoformat(str(v)[:10])
+    if tipo == 'float':
+        return float(v)
+    if tipo == 'int':
+        return int(v)
+    return str(v)
+
+class ExportadorBI:
+    """Escribe un dataset lote a lote: CSV gzip siempre, Parquet si hay pyarrow.
+    Cada llamada a escribir() es un row-group; los archivos se publican
+    (rename desde .tmp) solo si el bloque termina sin error."""
+
+    def __init__(self, nombre, columnas):
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        base = os.path.join(EXPORT_DIR, f"{nombre}_{date.today().strftime('%Y%m%d')}")
+        self.columnas = columnas
+        self.rutas    = [base + '.csv.gz'] + ([base + '.parquet'] if pa else [])
+        self.filas    = 0
+        self._pq  = None
+        self._gz  = gzip.open(self.rutas[0] + '.tmp', 'wt', encoding='utf-8', newline='')
+        try:
+            self._csv = csv.writer(self._gz)
+            self._csv.writerow([c for c, _, _ in columnas])
+            if pa:
+                tipos = {'str': pa.string(), 'float': pa.float64(), 'int': pa.int64(), 'date': pa.date32()}
+                self._schema = pa.schema([(c, tipos[t]) for c, _, t in columnas])
+                self._pq = pq.ParquetWriter(self.rutas[1] + '.tmp', self._schema, compression='zstd')
+        except BaseException:
+            self.__exit__(*sys.exc_info())
+            raise
+
+    def escribir(self, filas):
+        if not filas:
+            return
+        cols = {c: [_valor(f.get(k), t) for f in filas] for c, k, t in self.columnas}
+        self._csv.writerows(
+            ['' if v is None else v for v in fila] for fila in zip(*cols.values())
+        )
+        if self._pq:
+            self._pq.write_table(pa.table(cols, schema=self._schema))
+        self.filas += len(filas)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo_exc, *_):
+        try:
+            try:
+                self._gz.close()
+            finally:
+                if self._pq:
+                    self._pq.close()
+        except BaseException:
+            tipo_exc = tipo_exc or True   # un cierre fallido invalida los archivos
+            raise
+        finally:
+            for ruta in self.rutas:
+                if tipo_exc is None:
+                    os.replace(ruta + '.tmp', ruta)
+                elif os.path.exists(ruta + '.tmp'):
+                    os.remove(ruta + '.tmp')
+        return False
+
+def exportar_descuentos_lineas(models, uid):
+    """Todas las líneas de pedidos y facturas del período, sin umbral de descuento."""
+    dom_pedidos, dom_facturas = _dominios_descuentos()
+    list_prices, pedidos_info = {}, {}
+    fuentes = [
+        ('Pedido',  'sale.order.line',   dom_pedidos,  CAMPOS_LINEA_PEDIDO),
+        ('Factura', 'account.move.line', dom_facturas, CAMPOS_LINEA_FACTURA),
+    ]
+    with ExportadorBI('descuentos_lineas', COLS_DESCUENTOS) as exp:
+        for tipo, modelo, dominio, campos in fuentes:
+            for pagina in buscar_paginado(models, uid, modelo, dominio, campos):
+                _list_prices(models, uid, pagina, list_prices)
+                if tipo == 'Pedido':
+                    _info_pedidos(models, uid, pagina, pedidos_info)
+                exp.escribir([_linea_descuento(tipo, l, list_prices, pedidos_info)[1]
+                              for l in pagina])
+    return exp.filas
+
+def exportar_pedidos_atrasados(models, uid):
+    """Pedidos atrasados paginados desde Odoo; los pickings se piden por página."""
+    hoy = date.today()
+    dom_cot, dom_conf = _dominios_atrasados()
+    with ExportadorBI('pedidos_atrasados', COLS_PEDIDOS) as exp:
+        for pagina in buscar_paginado(models, uid, 'sale.order', dom_cot, CAMPOS_COTIZACION):
+            exp.escribir([{**_base_pedido(p, hoy), 'Estado': 'Sin confirmar'} for p in pagina])
+
+        for pagina in buscar_paginado(models, uid, 'sale.order', dom_conf, CAMPOS_CONFIRMADO):
+            ids = [i for p in pagina for i in p.get('picking_ids', [])]
+            pickings = {}
+            if ids:
+                pickings = {pk['id']: pk for pk in buscar(models, uid, 'stock.picking',
+                    [['id', 'in', ids]], ['id', 'name', 'state'], limite=len(ids))}
+            filas = []
+            for p in pagina:
+                base   = _base_pedido(p, hoy)
+                estado = _estado_confirmado(base, [pickings[i] for i in p.get('picking_ids', [])
+                                                   if i in pickings])
+                if estado:
+                    filas.append({**base, 'Estado': estado})
+            exp.escribir(filas)
+    return exp.filas
+
+def exportar_facturas_abiertas(models, uid):
+    """Todas las facturas abiertas con aging, paginadas directo desde Odoo."""
+    hoy = date.today()
+    with ExportadorBI('facturas_abiertas', COLS_FACTURAS) as exp:
+        for pagina in buscar_paginado(models, uid, 'account.move', FACTURAS_ABIERTAS,
+                ['name', 'partner_id', 'invoice_user_id', 'invoice_date',
+                 'invoice_date_due', 'amount_total', 'amount_residual']):
+            for f in pagina:
+                venc = f.get('invoice_date_due') or ''
+                dias = (hoy - datetime.strptime(venc, '%Y-%m-%d').date()).days if venc else 0
+                f['cliente_id']   = f['partner_id'][0] if f['partner_id'] else None
+                f['dias_vencido'] = dias
+                f['tramo']        = tramo_aging(dias)
+            exp.escribir(pagina)
+    return exp.filas
+
+def exportar_bi(models, uid):
+    """Datasets completos para BI, cada uno paginado desde Odoo (una página = un row-group)."""
+    if not EXPORT_DIR:
+        raise ValueError("EXPORTAR_BI=true requiere EXPORT_DIR (destino que lee el BI)")
+    for nombre, exportar in (('descuentos_lineas', exportar_descuentos_lineas),
+                             ('facturas_abiertas', exportar_facturas_abiertas),
+                             ('pedidos_atrasados', exportar_pedidos_atrasados)):
+        print(f"     {nombre}: {exportar(models, uid)} filas")
+    print(f"     formatos: csv.gz{' + parquet' if pa else ''} → {EXPORT_DIR}/")
+    return True
+
+
 # ══════════════════════════════════════════════
 # EXCEL — DESCUENTOS
 # ══════════════════════════════════════════════
@@ -509,8 +882,9 @@ def pdf_cobranza(resumen):
 # ══════════════════════════════════════════════
 # EMAIL HTML
 # ══════════════════════════════════════════════
-def generar_html(desc_res, cobr_res, pedidos):
+def generar_html(desc_res, cobr_res, pedidos, no_disponibles=None):
     hoy = date.today().strftime('%d/%m/%Y')
+    no_disponibles = no_disponibles or {}
 
     def fmt(v):
         try: return f"$ {int(v):,}".replace(',','.')
@@ -599,7 +973,14 @@ def generar_html(desc_res, cobr_res, pedidos):
             </tr>'''
         return t + '</table>'
 
-    def seccion(emoji, titulo, n, color, contenido):
+    def seccion(clave, emoji, titulo, n, color, contenido):
+        if clave in no_disponibles:
+            n = '—'
+            if _es_degradable(no_disponibles[clave]):
+                motivo = 'Odoo no respondió a tiempo. Se actualizará en el próximo envío.'
+            else:
+                motivo = 'la sección falló al generarse. Revisar el log de la ejecución.'
+            contenido = f'<p style="color:#c62828;font-style:italic;">⚠️ Sección no disponible: {motivo}</p>'
         return f'''<div style="margin-bottom:32px;">
           <h3 style="margin:0 0 12px;color:#1B3A6B;font-size:15px;border-left:4px solid {color};padding-left:12px;">
             {emoji} {titulo}
@@ -619,9 +1000,9 @@ def generar_html(desc_res, cobr_res, pedidos):
   </div>
 
   <div style="padding:28px 32px;">
-    {seccion('🏷️', f'Descuentos superiores al {int(DESC_AMARILLO)}%', len(desc_res), '#D32F2F', tabla_desc(desc_res))}
-    {seccion('💸', 'Cobranza vencida', len(cobr_res), '#E65100', tabla_cobr(cobr_res))}
-    {seccion('📦', 'Pedidos atrasados', len(pedidos), '#1565C0', tabla_ped(pedidos))}
+    {seccion('descuentos', '🏷️', f'Descuentos superiores al {int(DESC_AMARILLO)}%', len(desc_res), '#D32F2F', tabla_desc(desc_res))}
+    {seccion('cobranza', '💸', 'Cobranza vencida', len(cobr_res), '#E65100', tabla_cobr(cobr_res))}
+    {seccion('pedidos', '📦', 'Pedidos atrasados', len(pedidos), '#1565C0', tabla_ped(pedidos))}
   </div>
 
   <div style="background:#f8f9fb;padding:14px 32px;border-top:1px solid #e8eaed;text-align:center;">
@@ -634,66 +1015,263 @@ def generar_html(desc_res, cobr_res, pedidos):
 # ══════════════════════════════════════════════
 # ENVÍO EMAIL
 # ══════════════════════════════════════════════
-def enviar_email(html, excel_desc_bytes, pdf_cobr_bytes):
-    fecha_str = date.today().strftime('%Y%m%d')
-
-    msg = MIMEMultipart('mixed')
+TRAMO_B64    = 57 * 1024   # múltiplo de 57 → líneas base64 completas de 76
+MARGEN_PARTE = 2 * 1024    # cabeceras + frontera de cada adjunto
+MARGEN_MSG   = 8 * 1024    # cabeceras del mensaje + cuerpo de continuación
+
+def _tam_b64(n):
+    return -(-n // 57) * 78   # 76 caracteres + CRLF por cada 57 bytes
+
+def _tam(fuente):
+    fuente.seek(0, io.SEEK_END)
+    return fuente.tell()
+
+def _comprimir_zip(nombre, fuente):
+    destino = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX)
+    fuente.seek(0)
+    with zipfile.ZipFile(destino, 'w', zipfile.ZIP_DEFLATED) as zf:
+        with zf.open(nombre, 'w') as dst:
+            shutil.copyfileobj(fuente, dst, TRAMO_B64)
+    return destino
+
+def _preparar_adjuntos(adjuntos, limite, pila):
+    """Devuelve piezas (nombre, tipo, fuente, inicio, largo) que caben cada una
+    en un mensaje: lo que no cabe se comprime en zip y, si aún no cabe,
+    se parte en nombre(.zip).001, .002, ... (unir con cat).
+    Las fuentes abiertas aquí se cierran al salir de `pila` (ExitStack)."""
+    minimo = MARGEN_MSG + MARGEN_PARTE + 78
+    if limite < minimo:
+        raise ValueError(f"Límite de email de {limite:,} bytes: debe ser al menos "
+                         f"{minimo:,} (revisar EMAIL_MAX_MB / SIZE del servidor)")
+    piezas = []
+    for nombre, tipo, datos in adjuntos:
+        fuente = pila.enter_context(io.BytesIO(datos)) if isinstance(datos, bytes) else datos
+        tam    = _tam(fuente)
+        if _tam_b64(tam) + MARGEN_PARTE + MARGEN_MSG > limite:
+            comprimido = pila.enter_context(_comprimir_zip(nombre, fuente))
+            if _tam(comprimido) < tam:
+                print(f"     🗜️  {nombre}: {tam:,} → {_tam(comprimido):,} bytes (zip)")
+                fuente = comprimido
+                nombre, tipo, tam = nombre + '.zip', 'application/zip', _tam(fuente)
+        if _tam_b64(tam) + MARGEN_PARTE + MARGEN_MSG <= limite:
+            piezas.append((nombre, tipo, fuente, 0, tam))
+            continue
+        por_pieza = (limite - MARGEN_PARTE - MARGEN_MSG) // 78 * 57
+        n = -(-tam // por_pieza)
+        print(f"     ✂️  {nombre}: dividido en {n} partes")
+        for i in range(n):
+            piezas.append((f"{nombre}.{i+1:03d}", 'application/octet-stream',
+                           fuente, i * por_pieza, min(por_pieza, tam - i * por_pieza)))
+    return piezas
+
+def _repartir(html, piezas, limite):
+    """Agrupa las piezas en mensajes bajo el límite (first-fit: cada pieza va
+    al primer mensaje donde cabe); el primero lleva el HTML."""
+    grupos = [[]]
+    usados = [_tam_b64(len(html.encode('utf-8'))) + MARGEN_MSG]
+    for p in piezas:
+        t = _tam_b64(p[4]) + MARGEN_PARTE
+        for i, usado in enumerate(usados):
+            if usado + t <= limite:
+                break
+        else:
+            grupos.append([])
+            usados.append(MARGEN_MSG)
+            i = len(grupos) - 1
+        grupos[i].append(p)
+        usados[i] += t
+    return grupos
+
+def _escribir_cabeceras(fp, msg):
+    for k, v in msg.items():
+        fp.write(POLICY_SMTP.fold_binary(k, v))
+    fp.write(b'\r\n')
+
+def _escribir_b64(fp, fuente, inicio, largo):
+    fuente.seek(inicio)
+    while largo > 0:
+        tramo = fuente.read(min(TRAMO_B64, largo))
+        if not tramo:
+            break
+        largo -= len(tramo)
+        fp.write(base64.encodebytes(tramo).replace(b'\n', b'\r\n'))
+
+def _escribir_mensaje(fp, asunto, cuerpo, piezas):
+    """Serializa el mensaje en fp sin armar el árbol MIME completo en memoria:
+    el cuerpo va por BytesGenerator y cada adjunto en base64 por tramos."""
+    frontera = f"=_temponovo_{uuid.uuid4().hex}"
+    msg = MIMEMultipart('mixed', boundary=frontera, policy=POLICY_SMTP)
     msg['From']    = SMTP_USER
     msg['To']      = ', '.join(DESTINATARIOS)
-    msg['Subject'] = f"Reporte Temponovo — {date.today().strftime('%d/%m/%Y')}"
-    msg.attach(MIMEText(html, 'html', 'utf-8'))
-
-    part_xlsx = MIMEBase('application', 'vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-    part_xlsx.set_payload(excel_desc_bytes)
-    encoders.encode_base64(part_xlsx)
-    part_xlsx.add_header('Content-Disposition', f'attachment; filename="descuentos_{fecha_str}.xlsx"')
-    msg.attach(part_xlsx)
-
-    part_pdf = MIMEBase('application', 'pdf')
-    part_pdf.set_payload(pdf_cobr_bytes)
-    encoders.encode_base64(part_pdf)
-    part_pdf.add_header('Content-Disposition', f'attachment; filename="cobranza_{fecha_str}.pdf"')
-    msg.attach(part_pdf)
+    msg['Subject'] = asunto
+    _escribir_cabeceras(fp, msg)
+
+    fp.write(f'--{frontera}\r\n'.encode())
+    BytesGenerator(fp, policy=POLICY_SMTP).flatten(cuerpo)
+
+    for nombre, tipo, fuente, inicio, largo in piezas:
+        fp.write(f'\r\n--{frontera}\r\n'.encode())
+        parte = MIMEBase(*tipo.split('/', 1), policy=POLICY_SMTP)
+        parte['Content-Transfer-Encoding'] = 'base64'
+        parte.add_header('Content-Disposition', 'attachment', filename=nombre)
+        _escribir_cabeceras(fp, parte)
+        _escribir_b64(fp, fuente, inicio, largo)
+    fp.write(f'\r\n--{frontera}--\r\n'.encode())
+
+def _enviar_archivo(srv, fp):
+    """MAIL/RCPT/DATA a mano para mandar el mensaje desde fp por tramos.
+    Como sendmail: entrega a los destinatarios aceptados, devuelve los
+    rechazados y solo falla si se rechazan todos."""
+    tam = fp.tell()
+    code, resp = srv.mail(SMTP_USER, [f'SIZE={tam}'] if srv.has_extn('size') else [])
+    if code != 250:
+        srv.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, SMTP_USER)
+    rechazados = {}
+    for d in DESTINATARIOS:
+        code, resp = srv.rcpt(d)
+        if code not in (250, 251):
+            rechazados[d] = (code, resp)
+    if len(rechazados) == len(DESTINATARIOS):
+        srv.rset()
+        raise smtplib.SMTPRecipientsRefused(rechazados)
+    code, resp = srv.docmd('data')
+    if code != 354:
+        srv.rset()
+        raise smtplib.SMTPDataError(code, resp)
+
+    fp.seek(0)
+    buf = bytearray()
+    for linea in fp:
+        if linea.startswith(b'.'):
+            buf += b'.'
+        buf += linea
+        if len(buf) >= TRAMO_B64:
+            srv.send(bytes(buf))
+            buf.clear()
+    srv.send(bytes(buf) + b'.\r\n')
+    code, resp = srv.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+    return rechazados
+
+def enviar_email(html, excel_desc_bytes, pdf_cobr_bytes, incompleto=False):
+    fecha_str = date.today().strftime('%Y%m%d')
+    asunto    = f"Reporte Temponovo — {date.today().strftime('%d/%m/%Y')}" + (' (incompleto)' if incompleto else '')
+
+    # Adjuntos en None = sección no disponible
+    adjuntos = []
+    if excel_desc_bytes is not None:
+        adjuntos.append((f"descuentos_{fecha_str}.xlsx",
+                         'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                         excel_desc_bytes))
+    if pdf_cobr_bytes is not None:
+        adjuntos.append((f"cobranza_{fecha_str}.pdf", 'application/pdf', pdf_cobr_bytes))
+
+    # Lo que queda del plazo total (incluida la reserva para el envío)
+    timeout = RESERVA_ENVIO_SEG
+    if _plazo_global is not None:
+        timeout = max(_plazo_global + RESERVA_ENVIO_SEG - time.monotonic(), 10.0)
 
     ctx = ssl.create_default_context()
-    with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as srv:
+    with contextlib.ExitStack() as pila, smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=timeout) as srv:
         srv.ehlo()
         srv.starttls(context=ctx)
         srv.login(SMTP_USER, SMTP_PASSWORD)
-        srv.sendmail(SMTP_USER, DESTINATARIOS, msg.as_bytes())
 
-    print(f"✅ Email enviado")
+        limite = int(EMAIL_MAX_MB * 1024 * 1024)
+        if srv.has_extn('size') and int(srv.esmtp_features['size'] or 0) > 0:
+            limite = min(limite, int(srv.esmtp_features['size']))
+
+        grupos = _repartir(html, _preparar_adjuntos(adjuntos, limite, pila), limite)
+        for i, piezas in enumerate(grupos, 1):
+            if i == 1:
+                cuerpo = MIMEText(html, 'html', 'utf-8')
+            else:
+                cuerpo = MIMEText('Continuación de los adjuntos del reporte.\n'
+                                  'Para unir archivos partidos: cat archivo.001 archivo.002 ... > archivo',
+                                  'plain', 'utf-8')
+            sufijo = f" ({i}/{len(grupos)})" if len(grupos) > 1 else ''
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX) as fp:
+                _escribir_mensaje(fp, asunto + sufijo, cuerpo, piezas)
+                rechazados = _enviar_archivo(srv, fp)
+            for d, (code, resp) in rechazados.items():
+                print(f"   ⚠️  Mensaje {i}/{len(grupos)}: destinatario rechazado {d}: "
+                      f"{code} {resp.decode(errors='replace')}")
+
+    print(f"✅ Email enviado" + (f" ({len(grupos)} mensajes)" if len(grupos) > 1 else ''))
 
 
 # ══════════════════════════════════════════════
 # MAIN
 # ══════════════════════════════════════════════
 def main():
+    global _plazo_global
+    _plazo_global = time.monotonic() + PLAZO_TOTAL_SEG - RESERVA_ENVIO_SEG
+
     print(f"\n🚀 Reporte Temponovo — {datetime.now().strftime('%d/%m/%Y %H:%M')}")
-    uid, models = conectar_odoo()
-    print("✅ Conectado a Odoo")
+    no_disponibles = {}   # sección → error
+    fallidas       = []   # fallas no transitorias: la ejecución termina con exit 1
+    desc_res, desc_det, cobr_res, cobr_todos, pedidos = [], [], [], [], []
+
+    conexion, err = ejecutar_seccion('Conexión Odoo', conectar_odoo)
+    if err:
+        no_disponibles = dict.fromkeys(('descuentos', 'cobranza', 'pedidos'), err)
+    else:
+        uid, models = conexion
+        print("✅ Conectado a Odoo")
+
+        print("  🏷️  Descuentos...")
+        r, err = ejecutar_seccion('Descuentos', get_descuentos, models, uid)
+        if err:
+            no_disponibles['descuentos'] = err
+        else:
+            desc_res, desc_det = r
+            print(f"     {len(desc_res)} pedidos/facturas con descuento alto")
 
-    print("  🏷️  Descuentos...")
-    desc_res, desc_det = get_descuentos(models, uid)
-    print(f"     {len(desc_res)} pedidos/facturas con descuento alto")
+        print("  💸 Cobranza...")
+        r, err = ejecutar_seccion('Cobranza', get_cobranza, models, uid)
+        if err:
+            no_disponibles['cobranza'] = err
+        else:
+            cobr_res, cobr_todos = r
+            print(f"     {len(cobr_res)} clientes con deuda vencida >30d")
 
-    print("  💸 Cobranza...")
-    cobr_res, cobr_todos = get_cobranza(models, uid)
-    print(f"     {len(cobr_res)} clientes con deuda vencida >30d")
+        print("  📦 Pedidos atrasados...")
+        r, err = ejecutar_seccion('Pedidos atrasados', get_pedidos_atrasados, models, uid)
+        if err:
+            no_disponibles['pedidos'] = err
+        else:
+            pedidos = r
+            print(f"     {len(pedidos)} pedidos atrasados")
 
-    print("  📦 Pedidos atrasados...")
-    pedidos = get_pedidos_atrasados(models, uid)
-    print(f"     {len(pedidos)} pedidos atrasados")
+    fallidas += [k for k, e in no_disponibles.items() if not _es_degradable(e)]
 
     print("  📄 Generando adjuntos...")
-    excel_desc = excel_descuentos(desc_det)
-    pdf_cobr   = pdf_cobranza(cobr_todos)
+    excel_desc = excel_descuentos(desc_det)    if 'descuentos' not in no_disponibles else None
+    pdf_cobr   = pdf_cobranza(cobr_todos)      if 'cobranza'   not in no_disponibles else None
 
     print("  📧 Enviando email...")
-    html = generar_html(desc_res, cobr_res, pedidos)
-    enviar_email(html, excel_desc, pdf_cobr)
-
-    print("✅ Proceso completado\n")
+    html = generar_html(desc_res, cobr_res, pedidos, no_disponibles)
+    enviar_email(html, excel_desc, pdf_cobr, incompleto=bool(no_disponibles))
+
+    # Después del email para no demorar el reporte; el plazo global era para
+    # el envío, la exportación solo responde a su propio presupuesto
+    if EXPORTAR_BI and conexion is not None:
+        print("  🗄️  Exportando datasets BI...")
+        _plazo_global = None
+        _, err = ejecutar_seccion('Exportación BI', exportar_bi, models, uid,
+                                  presupuesto=PRESUPUESTO_EXPORT)
+        if err:
+            fallidas.append('exportación BI')
+
+    if fallidas:
+        print(f"❌ Proceso terminado con errores en: {', '.join(sorted(fallidas))}\n")
+        sys.exit(1)
+    if no_disponibles:
+        print(f"⚠️  Proceso completado con secciones no disponibles: {', '.join(sorted(no_disponibles))}\n")
+    else:
+        print("✅ Proceso completado\n")
 
 
 if __name__ == "__main__":